@@ -1,7 +1,10 @@
 import argparse
 import collections
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import functools
 from datetime import datetime, timedelta
 import hashlib
+import json
 import re
 import sys
 import os
@@ -29,11 +32,22 @@ dendroscope_binary = "/Applications/Dendroscope/Dendroscope.app/Contents/MacOS/J
 chromium_binary = "/usr/local/bin/chromium"
 
 class FocalTreeTs:
-    """Convenience class to access a single focal tree in a tree sequence"""
-    def __init__(self, ts, pos, basetime=None):
-        self.tree = ts.at(pos, sample_lists=True)
+    """
+    Convenience class to access a single focal tree in a tree sequence.
+    If given, sample_index maps each sample in ts.samples() to an integer that
+    identifies the same strain in another FocalTreeTs, so that the sets of samples
+    under nodes can be compared between trees. By default this is the sample order.
+    """
+    def __init__(self, ts, pos, basetime=None, sample_index=None):
+        self.tree = ts.at(pos)
         self.pos = pos
         self.basetime = basetime
+        if sample_index is None:
+            sample_index = np.arange(ts.num_samples)
+        self.node_to_sample_index = np.full(ts.num_nodes, -1, dtype=np.int32)
+        self.node_to_sample_index[ts.samples()] = sample_index
+        self._comment_arrays = {}
+        self._metadata_arrays = {}
 
     @property
     def ts(self):
@@ -46,15 +60,96 @@ class FocalTreeTs:
     def timediff(self, isodate):
         return getattr(self.basetime - datetime.fromisoformat(isodate), self.ts.time_units)
 
+    def timediffs(self, isodates):
+        """
+        Vectorised version of timediff: whole days between basetime and each date
+        """
+        assert self.ts.time_units == "days"
+        dates = np.array([datetime.fromisoformat(d) for d in isodates], dtype="datetime64[us]")
+        return ((np.datetime64(self.basetime, "us") - dates) // np.timedelta64(1, "D")).tolist()
+
+    @functools.cached_property
+    def leaf_order(self):
+        """
+        The leaves of the tree in minlex order, as used by default in draw_svg. Found
+        from the left_child and right_sib arrays rather than a minlex_postorder traversal
+        """
+        tree = self.tree
+        left_child = tree.left_child_array
+        right_sib = tree.right_sib_array
+
+        def children(u):
+            c = left_child[u]
+            while c != -1:
+                yield c
+                c = right_sib[c]
+
+        # Minimum leaf ID under each node, by which the children are ordered
+        min_leaf = {}
+        for u in tree.postorder():
+            min_leaf[u] = min((min_leaf[c] for c in children(u)), default=u)
+        order = []
+        stack = sorted(tree.roots, key=min_leaf.get, reverse=True)
+        while len(stack) > 0:
+            u = stack.pop()
+            if left_child[u] == -1:
+                order.append(u)
+            else:
+                stack.extend(sorted(children(u), key=min_leaf.get, reverse=True))
+        return order
+
+    @functools.cached_property
+    def node_metadata(self):
+        return decode_node_metadata(self.ts)
+
+    @functools.cached_property
+    def strain_array(self):
+        return [md.get("strain", "") for md in self.node_metadata]
+
     def strain(self, u):
-        return self.tree.tree_sequence.node(u).metadata.get("strain", "")
+        return self.strain_array[u]
+
+    def comment_array(self, key):
+        """
+        The value of `key` in the nextstrain "comment" metadata of each node, or None
+        """
+        if key not in self._comment_arrays:
+            self._comment_arrays[key] = [
+                md.get("comment", {}).get(key) for md in self.node_metadata]
+        return self._comment_arrays[key]
+
+    def metadata_array(self, key, comment=False):
+        """
+        Numpy string array of the value of `key` in the metadata of each node (or in
+        the nextstrain "comment" metadata if comment=True), with "" if missing
+        """
+        if (key, comment) not in self._metadata_arrays:
+            if comment:
+                values = self.comment_array(key)
+            else:
+                values = [md.get(key) for md in self.node_metadata]
+            self._metadata_arrays[(key, comment)] = np.array(
+                ["" if v is None else v for v in values], dtype=str)
+        return self._metadata_arrays[(key, comment)]
         
+    @functools.cached_property
+    def subtree_samples(self):
+        """
+        The sorted sample indexes under each node in the tree, indexed by node ID.
+        Built in a single postorder sweep rather than re-descending from each node
+        """
+        tree = self.tree
+        out = [None] * self.ts.num_nodes
+        for u in tree.nodes(order="postorder"):
+            acc = [self.node_to_sample_index[u]] if tree.is_sample(u) else []
+            for c in tree.children(u):
+                acc.extend(out[c])
+            out[u] = tuple(sorted(acc))
+        return out
+
     def hash_samples_under_node(self, u):
-        b2b = hashlib.blake2b(
-            " ".join(sorted([self.strain(s) for s in self.tree.samples(u)])).encode(),
-            digest_size=20,
-        )
-        return b2b.digest()
+        # The sorted sample indexes are a canonical key for the set of samples
+        return np.asarray(self.subtree_samples[u], dtype=np.int32).tobytes()
 
     
 class Nextstrain:
@@ -78,6 +173,16 @@ class Nextstrain:
         keep = [n.id for n in ts.nodes() if n.is_sample() and "strain" in n.metadata]
         self.ts = ts.simplify(keep)
 
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def load(filename, span, prefix="data"):
+        """
+        Return a Nextstrain instance, only parsing the file once for a given span within
+        a process. In "all" mode the figures are grouped by sc2ts input file, so the
+        wide and long cophylogenies run in different processes and each parses the file
+        """
+        return Nextstrain(filename, span, prefix=prefix)
+
     @staticmethod
     def pango_names(ts):
         # This is relevant to any nextstrain tree seq, not just the stored one
@@ -128,8 +233,40 @@ class Figure:
     """
     name = None
     ts_dir = "data"
+    sc2ts_filename = None  # The tree sequence in ts_dir that the figure is made from
     wide_fn = "upgma-full-md-30-mm-3-2021-06-30-recinfo-il.ts.tsz"
     long_fn = "upgma-mds-1000-md-30-mm-3-2022-06-30-recinfo-il.ts.tsz"
+    trees_cache_dir = os.path.join(".cache", "trees")
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def load_tsz(ts_dir, fn):
+        """
+        Return a tuple of tree seq and basetime. Each file is only loaded on first use,
+        and the result is shared between all figures made in the same process. An
+        uncompressed copy is kept in Figure.trees_cache_dir so that later runs (and
+        other processes) can skip the decompression
+        """
+        path = os.path.join(ts_dir, fn)
+        # Include the source directory in the key, so same-named files don't collide
+        dir_key = hashlib.blake2b(os.path.abspath(ts_dir).encode(), digest_size=8).hexdigest()
+        cache_path = os.path.join(
+            Figure.trees_cache_dir, f"{utils.snip_tsz_suffix(fn)}-{dir_key}.trees")
+        if (
+            os.path.exists(path)
+            and os.path.exists(cache_path)
+            and os.path.getmtime(cache_path) >= os.path.getmtime(path)
+        ):
+            logging.info(f"Loading uncompressed copy of {fn} from {cache_path}")
+            ts = tskit.load(cache_path)
+            return ts, sc2ts.last_date(ts)
+        ts, basetime = utils.load_tsz(ts_dir, fn)
+        os.makedirs(Figure.trees_cache_dir, exist_ok=True)
+        # Write then rename, so that concurrent runs never see a partial file
+        tmp_path = f"{cache_path}.{os.getpid()}"
+        ts.dump(tmp_path)
+        os.replace(tmp_path, cache_path)
+        return ts, basetime
 
     def plot(self):
         raise NotImplementedError()
@@ -140,6 +277,29 @@ class Cophylogeny(Figure):
     pos = 22000  # Position along tree seq to plot trees
     sc2ts_filename = None
     nextstrain_ts_fn = "nextstrain_ncov_gisaid_global_all-time_timetree-2023-01-21.nex"
+    tanglegram_cache_dir = os.path.join(".cache", "tanglegram")
+    # Dates for the time axis ticks, and whether to label them
+    _TICK_DATES = [
+        ("2020-01-01", True),
+        ("2020-02-01", False),
+        ("2020-03-01", False),
+        ("2020-04-01", True),
+        ("2020-05-01", False),
+        ("2020-06-01", False),
+        ("2020-07-01", True),
+        ("2020-08-01", False),
+        ("2020-09-01", False),
+        ("2020-10-01", True),
+        ("2020-11-01", False),
+        ("2020-12-01", False),
+        ("2021-01-01", True),
+        ("2021-02-01", False),
+        ("2021-03-01", False),
+        ("2021-04-01", True),
+        ("2021-05-01", False),
+        ("2021-06-01", False),
+        ("2021-07-01", True),
+    ]
 
     # Utility functions
     @staticmethod
@@ -147,40 +307,60 @@ class Cophylogeny(Figure):
         """
         Map strain name to order of leaf node in a tree
         """
-        tree = focal_tree_ts.tree
-        # Can't use the tree.leaves iterator as we need to specify order
-        leaves = [u for u in tree.nodes(order="minlex_postorder") if tree.is_leaf(u)]
-        return {focal_tree_ts.strain(v): i for i, v in enumerate(leaves)}
+        strains = focal_tree_ts.strain_array
+        return {strains[v]: i for i, v in enumerate(focal_tree_ts.leaf_order)}
 
-    @staticmethod
-    def run_nnet_untangle(trees):
+    @classmethod
+    def run_nnet_untangle(cls, trees):
         assert len(trees) == 2
+        newick_strings = [tree.as_newick() for tree in trees]
+        # Dendroscope is slow, so cache the resulting order under a hash of the input
+        key = hashlib.blake2b("\n".join(newick_strings).encode(), digest_size=16).hexdigest()
+        cache_path = os.path.join(cls.tanglegram_cache_dir, key + ".json")
+        if os.path.exists(cache_path):
+            logging.info(f"Using cached tanglegram order from {cache_path}")
+            with open(cache_path, "rt") as file:
+                return json.load(file)
         with tempfile.TemporaryDirectory() as tmpdirname:
             newick_path = os.path.join(tmpdirname, "cophylo.nwk")
             command_path = os.path.join(tmpdirname, "commands.txt")
             with open(newick_path, "wt") as file:
-                for tree in trees:
-                    print(tree.as_newick(), file=file)
+                for newick in newick_strings:
+                    print(newick, file=file)
             with open(command_path, "wt") as file:
                 print(f"open file='{newick_path}';", file=file)
                 print("compute tanglegram method=nnet", file=file)
                 print(f"save format=newick file='{newick_path}'", file=file) # overwrite
                 print("quit;", file=file)
-            subprocess.run([dendroscope_binary, "-g", "-c", command_path])
+            # Fail rather than cache the unchanged input order if Dendroscope fails
+            subprocess.run([dendroscope_binary, "-g", "-c", command_path], check=True)
             order = []
             with open(newick_path, "rt") as newicks:
                 for line in newicks:
                     # hack: use the order of `nX encoded in the string
                     order.append([int(n[1:]) for n in re.findall(r'n\d+', line)])
+        os.makedirs(cls.tanglegram_cache_dir, exist_ok=True)
+        # Write then rename, so that concurrent runs never see a partial file
+        tmp_path = f"{cache_path}.{os.getpid()}"
+        with open(tmp_path, "wt") as file:
+            json.dump(order, file)
+        os.replace(tmp_path, cache_path)
         return order
 
+    @classmethod
+    def y_ticks(cls, focal_tree_ts):
+        return dict(zip(
+            focal_tree_ts.timediffs([d for d, _ in cls._TICK_DATES]),
+            [d[:7] if show else "" for d, show in cls._TICK_DATES],
+        ))
+
     def __init__(self, args):
         """
         Defines two simplified tree sequences, focussed on a specific tree. These are
         stored in self.sc2ts and self.nxstr
         """
-        sc2ts_arg, basetime = utils.load_tsz(self.ts_dir, self.sc2ts_filename)
-        nextstrain = Nextstrain(self.nextstrain_ts_fn, span=sc2ts_arg.sequence_length)
+        sc2ts_arg, basetime = self.load_tsz(self.ts_dir, self.sc2ts_filename)
+        nextstrain = Nextstrain.load(self.nextstrain_ts_fn, sc2ts_arg.sequence_length)
         
         # Slow step: find the samples in sc2ts_arg.ts also in nextstrain.ts, and subset
         sc2ts_its, nxstr_its = sc2ts.subset_to_intersection(
@@ -192,34 +372,39 @@ class Cophylogeny(Figure):
         )
         
         # Check first set of samples map
-        for u, v in zip(sc2ts_its.samples(), nxstr_its.samples()):
-            assert sc2ts_its.node(u).metadata["strain"] == nxstr_its.node(v).metadata["strain"]
+        n = min(sc2ts_its.num_samples, nxstr_its.num_samples)
+        assert np.array_equal(sample_strains(sc2ts_its, n), sample_strains(nxstr_its, n))
         
         ## Filter from entire TS:
-        # Some of the samples in sc2_its are recombinants: remove these from both trees
-        sc2ts_simp_its = sc2ts_its.simplify(
-            sc2ts_its.samples()[0:nxstr_its.num_samples],
-            keep_unary=True,
-            filter_nodes=False)
-        assert sc2ts_simp_its.num_samples == sc2ts_simp_its.num_samples
-        for u, v in zip(sc2ts_simp_its.samples(), nxstr_its.samples()):
-            assert sc2ts_simp_its.node(u).metadata["strain"] == nxstr_its.node(v).metadata["strain"]
-    
+        # Some of the samples in sc2_its are recombinants: remove these from both trees.
+        # Some of the remaining samples are internal in the focal tree: also remove those
+        # from both datasets. Do both in a single simplify of the (large) ARG
+        candidates = sc2ts_its.samples()[0:nxstr_its.num_samples]
         logging.info(
-            f"Removed {sc2ts_its.num_samples-sc2ts_simp_its.num_samples} samples "
+            f"Removed {sc2ts_its.num_samples - len(candidates)} samples "
             "in sc2 not in nextstrain"
         )
-    
-        ## Filter from trees
-        # Some samples in sc2ts_simp_its are internal. Remove those from both datasets
-        keep = np.array([u for u in sc2ts_simp_its.at(self.pos).leaves()])
+        # Once the other samples are removed, a candidate is a leaf in the focal tree
+        # if no other candidate is below it. Subtrees are contiguous in preorder, so this
+        # is when the next candidate in preorder is not a descendant, i.e. is not before
+        # it in postorder. Keep the leaves in preorder, as this is the untangling start point
+        tree = sc2ts_its.at(self.pos)
+        preorder = tree.preorder()
+        postorder_rank = np.empty(sc2ts_its.num_nodes, dtype=np.int64)
+        postorder_rank[tree.postorder()] = np.arange(len(preorder))
+        candidate_index = np.full(sc2ts_its.num_nodes, -1)
+        candidate_index[candidates] = np.arange(len(candidates))
+        ordered = preorder[candidate_index[preorder] >= 0]
+        is_leaf = np.ones(len(ordered), dtype=bool)
+        is_leaf[:-1] = postorder_rank[ordered[1:]] > postorder_rank[ordered[:-1]]
+        keep = candidate_index[ordered[is_leaf]]  # indexes into the aligned samples of both
     
         # Change the random seed here to change the untangling start point
         #rng = np.random.default_rng(777)
         #keep = rng.shuffle(keep)
-        sc2ts_tip = sc2ts_simp_its.simplify(keep)
+        sc2ts_tip = sc2ts_its.simplify(candidates[keep])
         assert nxstr_its.num_trees == 1
-        nxstr_tip = nxstr_its.simplify(keep)
+        nxstr_tip = nxstr_its.simplify(nxstr_its.samples()[keep])
         logging.info(
             "Removed internal samples in first tree. Trees now have "
             f"{sc2ts_tip.num_samples} leaf samples"
@@ -230,33 +415,26 @@ class Cophylogeny(Figure):
             [sc2ts_tip.at(self.pos), nxstr_tip.first()])
     
         # Align the time in the nextstrain tree to the sc2ts tree
-        ns_sc2_time_difference = []
-        for s1, s2 in zip(
-            sc2ts_tip.samples(),
-            nxstr_tip.samples()
-        ):
-            n1 = sc2ts_tip.node(s1)
-            n2 = nxstr_tip.node(s2)
-            assert n1.metadata["strain"] == n2.metadata["strain"]
-            ns_sc2_time_difference.append(n1.time - n2.time)
-        dt = timedelta(**{nxstr_tip.time_units: np.median(ns_sc2_time_difference)})
+        assert np.array_equal(sample_strains(sc2ts_tip), sample_strains(nxstr_tip))
+        ns_sc2_time_difference = (
+            sc2ts_tip.nodes_time[sc2ts_tip.samples()] - nxstr_tip.nodes_time[nxstr_tip.samples()])
+        dt = timedelta(**{nxstr_tip.time_units: float(np.median(ns_sc2_time_difference))})
     
         nxstr_order = list(reversed(nxstr_order))  # RH tree rotated so reverse the order
 
+        # The samples in sc2ts_tip and nxstr_tip are aligned, and have IDs 0..n-1, so
+        # the tip sample IDs identify the same strain in the reordered tree seqs
         self.sc2ts = FocalTreeTs(
-            sc2ts_tip.simplify(sc2ts_order), self.pos, basetime)
+            sc2ts_tip.simplify(sc2ts_order), self.pos, basetime, sample_index=sc2ts_order)
         self.nxstr = FocalTreeTs(
-            nxstr_tip.simplify(nxstr_order), self.pos, basetime - dt)
+            nxstr_tip.simplify(nxstr_order), self.pos, basetime - dt, sample_index=nxstr_order)
 
         logging.info(f"{self.sc2ts.ts.num_trees} trees in the simplified 'backbone' ARG")
 
     def plot(self):
         prefix = os.path.join("figures", self.name)
-        strain_id_map = {
-            self.sc2ts.strain(n): n
-            for n in self.sc2ts.samples
-            if self.sc2ts.strain(n) != ""
-        }
+        sc2ts_strains = self.sc2ts.strain_array
+        strain_id_map = {sc2ts_strains[n]: n for n in self.sc2ts.samples if sc2ts_strains[n] != ""}
     
         # A few color schemes to try
         cmap = get_cmap("tab20b", 50)
@@ -299,23 +477,22 @@ class Cophylogeny(Figure):
     
         # Assign colours
         col = colours[self.use_colour]
-        nxstr_styles = []
-        sc2ts_styles = []
+        nxstr_styles = [None] * self.nxstr.ts.num_nodes
+        sc2ts_styles = [None] * self.nxstr.ts.num_nodes
         legend = {}
-        for n in self.nxstr.ts.nodes():
-            clade = n.metadata.get("comment", {}).get(col["md_key"], None)
-            if clade is not None:
-                if clade in col["scheme"]:
-                    legend[clade] = col['scheme'][clade]
-                    nxstr_styles.append(
-                        f".nxstr .n{n.id} .edge {{stroke: {col['scheme'][clade]}}}")
-                    s = self.nxstr.strain(n.id)
-                    if s in strain_id_map:
-                        sc2ts_styles.append(
-                            f".sc2ts .n{strain_id_map[s]} .edge {{stroke: {col['scheme'][clade]}}}")
+        for u, clade in enumerate(self.nxstr.comment_array(col["md_key"])):
+            if clade is not None and clade in col["scheme"]:
+                legend[clade] = col['scheme'][clade]
+                nxstr_styles[u] = f".nxstr .n{u} .edge {{stroke: {col['scheme'][clade]}}}"
+                s = self.nxstr.strain_array[u]
+                if s in strain_id_map:
+                    sc2ts_styles[u] = (
+                        f".sc2ts .n{strain_id_map[s]} .edge {{stroke: {col['scheme'][clade]}}}")
+        nxstr_styles = list(filter(None, nxstr_styles))
+        sc2ts_styles = list(filter(None, sc2ts_styles))
         
         # Find shared splits to plot as solid circular nodes
-        # uses a hash to summarise the samples under a node, otherwise the sets get big
+        # uses a key to summarise the samples under a node, otherwise the sets get big
         nxstr_hashes = {
             self.nxstr.hash_samples_under_node(u): u
             for u in self.nxstr.tree.nodes()
@@ -327,104 +504,62 @@ class Cophylogeny(Figure):
             if not self.sc2ts.tree.is_sample(u)
         }
         
-        shared_split_keys = set(nxstr_hashes.keys()).intersection(set(sc2ts_hashes.keys()))
+        small, large = sorted((nxstr_hashes, sc2ts_hashes), key=len)
+        shared_split_keys = [key for key in small if key in large]
         for key in shared_split_keys:
             nxstr_styles.append(f".nxstr .n{nxstr_hashes[key]} > .sym {{r: 3px}}")
             sc2ts_styles.append(f".sc2ts .n{sc2ts_hashes[key]} > .sym {{r: 3px}}")
         
         focal_nodes = {"Delta": {}, "Alpha": {}}
-        for nm, tree in zip(("sc2ts", "nxstr"), (self.sc2ts.tree, self.nxstr.tree)):
-            delta = []
-            alpha = []
-            for node in tree.tree_sequence.nodes():
-                if node.is_sample():
-                    if nm == "nxstr":
-                        pango = node.metadata.get("comment", {}).get("pango_lineage", "")
-                    else:
-                        pango = node.metadata.get("Nextclade_pango", "")
-                    if pango.startswith("AY") or pango == "B.1.617.2":
-                        delta.append(node.id)
-                    if pango == "B.1.1.7":
-                        alpha.append(node.id)
-            focal_nodes["Delta"][nm] = tree.mrca(*delta)
-            focal_nodes["Alpha"][nm] = tree.mrca(*alpha)
+        for nm, focal_ts in [("sc2ts", self.sc2ts), ("nxstr", self.nxstr)]:
+            if nm == "nxstr":
+                pango = focal_ts.metadata_array("pango_lineage", comment=True)
+            else:
+                pango = focal_ts.metadata_array("Nextclade_pango")
+            samples = focal_ts.samples
+            sample_pango = pango[samples]
+            delta = samples[np.char.startswith(sample_pango, "AY") | (sample_pango == "B.1.617.2")]
+            alpha = samples[sample_pango == "B.1.1.7"]
+            focal_nodes["Delta"][nm] = focal_ts.tree.mrca(*delta.tolist())
+            focal_nodes["Alpha"][nm] = focal_ts.tree.mrca(*alpha.tolist())
         
         node_labels = {}
         for nm, focal_ts in [("sc2ts", self.sc2ts), ("nxstr", self.nxstr)]:
-            node_labels[nm] = {u: focal_ts.strain(u) for u in focal_ts.tree.nodes()}
+            strains = focal_ts.strain_array
+            node_labels[nm] = {u: strains[u] for u in focal_ts.tree.nodes()}
             node_labels[nm].update({focal_nodes[k][nm]: k for k in focal_nodes})
         
-        svg1 = self.sc2ts.tree.draw_svg(
-            size=(800, 400),
-            canvas_size=(800, 800),
-            node_labels=node_labels['sc2ts'],
-            root_svg_attributes = {"class": "sc2ts"},
-            mutation_labels={},
-            omit_sites=True,
-            symbol_size=1,
-            y_axis=True,
-            y_ticks={
-                self.sc2ts.timediff(isodate): (isodate[:7] if show else "")
-                for isodate, show in {
-                    '2020-01-01': True,
-                    '2020-02-01': False,
-                    '2020-03-01': False,
-                    '2020-04-01': True,
-                    '2020-05-01': False,
-                    '2020-06-01': False,
-                    '2020-07-01': True,
-                    '2020-08-01': False,
-                    '2020-09-01': False,
-                    '2020-10-01': True,
-                    '2020-11-01': False,
-                    '2020-12-01': False,
-                    '2021-01-01': True,
-                    '2021-02-01': False,
-                    '2021-03-01': False,
-                    '2021-04-01': True,
-                    '2021-05-01': False,
-                    '2021-06-01': False,
-                    '2021-07-01': True,
-                }.items()
-            },
-            y_label=" ",
-        )
-        
-        svg2 = self.nxstr.tree.draw_svg(
-            size=(800, 400),
-            canvas_size=(900, 800),  # Allow for time axis at the other side of the tree
-            node_labels = node_labels['nxstr'],
-            root_svg_attributes = {"class": "nxstr"},
-            mutation_labels={},
-            omit_sites=True,
-            symbol_size=1,
-            y_axis=True,
-            y_ticks={
-                self.nxstr.timediff(isodate): (isodate[:7] if show else "")
-                for isodate, show in {
-                    '2020-01-01': True,
-                    '2020-02-01': False,
-                    '2020-03-01': False,
-                    '2020-04-01': True,
-                    '2020-05-01': False,
-                    '2020-06-01': False,
-                    '2020-07-01': True,
-                    '2020-08-01': False,
-                    '2020-09-01': False,
-                    '2020-10-01': True,
-                    '2020-11-01': False,
-                    '2020-12-01': False,
-                    '2021-01-01': True,
-                    '2021-02-01': False,
-                    '2021-03-01': False,
-                    '2021-04-01': True,
-                    '2021-05-01': False,
-                    '2021-06-01': False,
-                    '2021-07-01': True,
-                }.items()
-            },
-            y_label=" ",
-        )
+        # The two trees are independent, so submit them together. draw_svg is mostly pure
+        # Python and holds the GIL, so the threads only overlap its C-level tree traversal
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            sc2ts_future = executor.submit(
+                self.sc2ts.tree.draw_svg,
+                size=(800, 400),
+                canvas_size=(800, 800),
+                node_labels=node_labels['sc2ts'],
+                root_svg_attributes = {"class": "sc2ts"},
+                mutation_labels={},
+                omit_sites=True,
+                symbol_size=1,
+                y_axis=True,
+                y_ticks=self.y_ticks(self.sc2ts),
+                y_label=" ",
+            )
+            nxstr_future = executor.submit(
+                self.nxstr.tree.draw_svg,
+                size=(800, 400),
+                canvas_size=(900, 800),  # Allow for time axis at the other side of the tree
+                node_labels = node_labels['nxstr'],
+                root_svg_attributes = {"class": "nxstr"},
+                mutation_labels={},
+                omit_sites=True,
+                symbol_size=1,
+                y_axis=True,
+                y_ticks=self.y_ticks(self.nxstr),
+                y_label=" ",
+            )
+            svg1 = sc2ts_future.result()
+            svg2 = nxstr_future.result()
         
         names_lft = self.strain_order(self.sc2ts)
         names_rgt = self.strain_order(self.nxstr)
@@ -480,32 +615,41 @@ class Cophylogeny(Figure):
             sc2ts_str += "first tree"
         else:
             sc2ts_str += f"tree @ position {self.sc2ts.pos}"
-        svg_string = (
-            '<svg baseProfile="full" height="800" version="1.1" width="900" id="main"' +
-            ' xmlns="http://www.w3.org/2000/svg" ' +
-            'xmlns:ev="http://www.w3.org/2001/xml-events" xmlns:xlink="http://www.w3.org/1999/xlink">' +
-            f'<defs><style>{"".join(global_styles)}</style></defs>'
-            f'<text text-anchor="middle" transform="translate(200, 12)">{sc2ts_str}</text>' +
-            '<text text-anchor="middle" transform="translate(600, 12)">Nextstrain tree</text>' +
-            '<g>' + ''.join([
-                f'<line x1="{v["lft"][0]}" y1="{v["lft"][1]}" x2="{v["rgt"][0]}" y2="{v["rgt"][1]}" stroke="#CCCCCC" />'
-                for v in loc.values()
-                ])+
-            '</g>' +
-            '<g class="left_tree" transform="translate(0 800) rotate(-90)">' +
-            svg1 +
-            '</g><g class="right_tree" transform="translate(800 -37) rotate(90)">' +
-            svg2 +
-            '</g>' + 
-            '<g class="legend" transform="translate(800 30)">' +
-            f'<text>{self.use_colour} lineage</text>' +
-            "".join(f'<line x1="0" y1="{25+i*15}" x2="15" y2="{25+i*15}" stroke-width="2" stroke="{legend[nm]}" /><text font-size="10pt" x="20" y="{30+i*15}">{nm}</text>' for i, nm in enumerate(sorted(legend))) +
-            '</g>' + 
-            '</svg>'
+        # Accumulate the parts of the (large) svg and write them out without joining
+        svg_parts = [
+            '<svg baseProfile="full" height="800" version="1.1" width="900" id="main"',
+            ' xmlns="http://www.w3.org/2000/svg" ',
+            'xmlns:ev="http://www.w3.org/2001/xml-events" xmlns:xlink="http://www.w3.org/1999/xlink">',
+            '<defs><style>',
+        ]
+        svg_parts.extend(global_styles)
+        svg_parts.extend([
+            '</style></defs>',
+            f'<text text-anchor="middle" transform="translate(200, 12)">{sc2ts_str}</text>',
+            '<text text-anchor="middle" transform="translate(600, 12)">Nextstrain tree</text>',
+            '<g>',
+        ])
+        line_coords = np.array([v["lft"] + v["rgt"] for v in loc.values()]).tolist()
+        line_template = '<line x1="%.1f" y1="%.1f" x2="%.1f" y2="%.1f" stroke="#CCCCCC" />'
+        svg_parts.extend(line_template % tuple(xy) for xy in line_coords)
+        svg_parts.extend([
+            '</g>',
+            '<g class="left_tree" transform="translate(0 800) rotate(-90)">',
+            svg1,
+            '</g><g class="right_tree" transform="translate(800 -37) rotate(90)">',
+            svg2,
+            '</g>',
+            '<g class="legend" transform="translate(800 30)">',
+            f'<text>{self.use_colour} lineage</text>',
+        ])
+        svg_parts.extend(
+            f'<line x1="0" y1="{25+i*15}" x2="15" y2="{25+i*15}" stroke-width="2" stroke="{legend[nm]}" /><text font-size="10pt" x="20" y="{30+i*15}">{nm}</text>'
+            for i, nm in enumerate(sorted(legend))
         )
+        svg_parts.extend(['</g>', '</svg>'])
     
         with open(f"{prefix}.svg", "wt") as file:
-            file.write(svg_string)
+            file.writelines(svg_parts)
         subprocess.run([
             chromium_binary,
             "--headless",
@@ -519,25 +663,25 @@ class Cophylogeny(Figure):
 
 class CophylogenyWide(Cophylogeny):
     name = "cophylogeny_wide"
-    sc2ts_filename = "upgma-full-md-30-mm-3-2021-06-30-recinfo-il.ts.tsz"
+    sc2ts_filename = Figure.wide_fn
     use_colour = "Pango"
 
 
 class CophylogenyLong(Cophylogeny):
     name = "supp_cophylogeny_long"
-    sc2ts_filename = "upgma-mds-1000-md-30-mm-3-2022-06-30-recinfo-il.ts.tsz"
+    sc2ts_filename = Figure.long_fn
     use_colour = "Pango"
 
 
 class RecombinationNodeMrcas(Figure):
     name = None
-    sc2ts_filename = "upgma-mds-1000-md-30-mm-3-2022-06-30-recinfo-il.ts.tsz"
+    sc2ts_filename = Figure.long_fn
     csv_fn = "breakpoints_{}.csv"
     data_dir = "data"
     
     
     def __init__(self, args):
-        self.ts, self.basetime = utils.load_tsz(self.data_dir, self.sc2ts_filename)
+        self.ts, self.basetime = self.load_tsz(self.ts_dir, self.sc2ts_filename)
 
         prefix = utils.snip_tsz_suffix(self.sc2ts_filename)
         df = pd.read_csv(os.path.join(self.data_dir, self.csv_fn.format(prefix)))
@@ -562,8 +706,15 @@ class RecombinationNodeMrcas(Figure):
     @staticmethod
     def add_common_lines(ax, num, ts, common_proportions):
         v_pos = {k: v for v, k in enumerate(common_proportions.keys())}
+        # Count distinct children of every node in one pass over the edge table
+        order = np.lexsort((ts.edges_child, ts.edges_parent))
+        parents = ts.edges_parent[order]
+        children = ts.edges_child[order]
+        is_new = np.ones(ts.num_edges, dtype=bool)
+        is_new[1:] = (parents[1:] != parents[:-1]) | (children[1:] != children[:-1])
+        child_counts = np.bincount(parents[is_new], minlength=ts.num_nodes)
         for i, (u, (pango, prop)) in enumerate(common_proportions.items()):
-            n_children = len(np.unique(ts.edges_child[ts.edges_parent == u]))
+            n_children = int(child_counts[u])
             logging.info(
                 f"{ordinal(i+1)} most freq. parent MRCA has id {u} (imputed: {pango}) "
                 f"@ time={ts.node(u).time}; "
@@ -615,20 +766,18 @@ class RecombinationNodeMrcas(Figure):
         hist_ax.hist(df.tmrca_delta/7, bins=60, density=True)
 
         
-        x = []
-        y = []
-        for row in df.itertuples():
-            if row.origin_nextclade_pango.startswith("X"):
-                x.append(row.tmrca_delta/7)
-                y.append(row.tmrca)
-                main_ax.text(
-                    x[-1] + label_tweak[0],
-                    y[-1] + label_tweak[1],  # Tweak so it is above the point
-                    row.origin_nextclade_pango,
-                    size=6,
-                    ha='center',
-                    rotation=70,
-                )
+        is_x = df.origin_nextclade_pango.str.startswith("X", na=False).to_numpy()
+        x = df.tmrca_delta.to_numpy()[is_x] / 7
+        y = df.tmrca.to_numpy()[is_x]
+        for xi, yi, label in zip(x, y, df.origin_nextclade_pango.to_numpy()[is_x]):
+            main_ax.text(
+                xi + label_tweak[0],
+                yi + label_tweak[1],  # Tweak so it is above the point
+                label,
+                size=6,
+                ha='center',
+                rotation=70,
+            )
         main_ax.scatter(x, y, c="orange", s=8)
 
 
@@ -746,6 +895,35 @@ def get_subclasses(cls):
         yield from get_subclasses(subclass)
         yield subclass
 
+def decode_node_metadata(ts):
+    """
+    Decode the metadata of all nodes directly from the packed metadata column,
+    avoiding the creation of a Node object for each one
+    """
+    node_table = ts.tables.nodes
+    schema = node_table.metadata_schema
+    md = node_table.metadata
+    offset = node_table.metadata_offset
+    return [schema.decode_row(md[offset[u]:offset[u + 1]].tobytes()) for u in range(ts.num_nodes)]
+
+def sample_strains(ts, num_samples=None):
+    """
+    Return a numpy array of the strain names of the first num_samples samples in ts
+    """
+    # Only a few rows are needed, so avoid copying the tables of a potentially large ts
+    samples = ts.samples()[:num_samples]
+    return np.array([ts.node(u).metadata["strain"] for u in samples], dtype=str)
+
+def make_figures(names, args, level=logging.WARNING):
+    """
+    Create and plot the named figures in turn. Module level so it can be run in a
+    worker process
+    """
+    logging.basicConfig(level=level)
+    name_map = {fig.name: fig for fig in get_subclasses(Figure) if fig.name is not None}
+    for name in names:
+        name_map[name](args).plot()
+
 def ordinal(n):
     return ["First", "Second", "Third", "Fourth", "Fifth", "Sixth", "Seventh"][n - 1]
 
@@ -804,9 +982,16 @@ def main():
     logging.basicConfig(level=level)
 
     if args.name == "all":
-        for _, fig in name_map.items():
-            if fig in figures:
-                fig(args).plot()
+        # Figures are independent, so make them in parallel. Group them by input file so
+        # each tree sequence is only loaded (and held in memory) by a single worker
+        groups = collections.defaultdict(list)
+        for name, fig in name_map.items():
+            groups[(fig.ts_dir, fig.sc2ts_filename)].append(name)
+        groups = list(groups.values())
+        max_workers = min(len(groups), os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(
+                make_figures, groups, [args] * len(groups), [level] * len(groups)))
     else:
         fig = name_map[args.name](args)
         fig.plot()